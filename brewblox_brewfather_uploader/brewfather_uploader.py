@@ -3,12 +3,118 @@ Example on how to set up a feature that polls data, and publishes to the eventbu
 """
 
 import asyncio
+import functools
+import json
+import os
 
+import ijson
+import orjson
 from aiohttp import web, ClientResponseError
 from brewblox_service import brewblox_logger, features, http, repeater
-from yaml import safe_load
+from yaml import load as yaml_load
+
+try:
+    # the libyaml-backed loader is much faster, but only available
+    # if PyYAML was built against libyaml
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader as YamlLoader
+
 LOGGER = brewblox_logger(__name__)
 
+# orjson serializes to bytes, so aiohttp can't set the content type itself
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Parsed config files, keyed by (path, mtime)
+# A restarted repeater re-enters prepare(), but the config rarely changes
+_YAML_CACHE = dict()
+
+
+def _load_yaml_cached(path):
+    """Loads and parses a YAML file, reusing the previous result
+    when the file has not been modified since.
+
+    A parsed copy is kept as JSON next to the YAML file,
+    so cold starts with an unchanged config can skip YAML parsing entirely."""
+    cache_key = (path, os.path.getmtime(path))
+    if cache_key not in _YAML_CACHE:
+        json_path = f'{path}.cache.json'
+        try:
+            if os.path.getmtime(json_path) >= cache_key[1]:
+                with open(json_path) as jsonfile:
+                    _YAML_CACHE[cache_key] = json.load(jsonfile)
+                return _YAML_CACHE[cache_key]
+        except (OSError, ValueError):
+            # missing or stale cache file: fall through to the YAML parse
+            pass
+
+        with open(path) as yamlfile:
+            _YAML_CACHE[cache_key] = yaml_load(yamlfile, Loader=YamlLoader)
+
+        try:
+            # JSON turns non-string keys into strings, so only cache configs
+            # that survive the round-trip unchanged; otherwise warm and cold
+            # loads could disagree
+            encoded = json.dumps(_YAML_CACHE[cache_key])
+            if json.loads(encoded) == _YAML_CACHE[cache_key]:
+                # write-and-rename so a crash can't leave a truncated cache file
+                with open(f'{json_path}.tmp', 'w') as jsonfile:
+                    jsonfile.write(encoded)
+                os.replace(f'{json_path}.tmp', json_path)
+        except (OSError, TypeError, ValueError):
+            # the config dir may be read-only, or the config may contain
+            # values JSON can't represent (e.g. dates);
+            # the cache is just an optimization either way
+            LOGGER.debug('Could not write config cache file: %s', json_path)
+    return _YAML_CACHE[cache_key]
+
+
+@functools.lru_cache(maxsize=4)
+def _metric_suffixes(temp_unit, gravity_unit):
+    """Builds the (brewfather_field, service_type, uncalibrated) -> metric suffix table.
+
+    The units are constant for the life of the service,
+    so the table is only ever built once per unit combination."""
+    gravity_unit_string = 'specificGravity' if gravity_unit == 'G' else 'Plato[degP]'
+
+    suffixes = {
+        ('gravity', 'tilt', True): f'uncalibrated{gravity_unit_string[0].upper()+gravity_unit_string[1:]}',
+        ('gravity', 'tilt', False): f'{gravity_unit_string}'
+    }
+    for temp_field in ('temp', 'aux_temp', 'ext_temp'):
+        suffixes[(temp_field, 'tilt', True)] = f'uncalibratedTemperature[deg{temp_unit}]'
+        suffixes[(temp_field, 'tilt', False)] = f'temperature[deg{temp_unit}]'
+        suffixes[(temp_field, 'spark', False)] = f'value[deg{temp_unit}]'
+    return suffixes
+
+
+def _make_payload_builder(fermenter_name, metric_pairs, temp_unit, gravity_unit):
+    """Returns a builder specialized to one fermenter's configuration.
+
+    The name/unit keys and (metric, brewfather_field) pairs are fixed
+    after prepare(), so that part of the payload is serialized here, once;
+    each tick only the metric values from the {metric: value} dict are
+    serialized and spliced in. Returns None when no metric has a value."""
+    # strip the closing brace, so the metric fields can be appended
+    static_prefix = orjson.dumps({
+        'name': fermenter_name,
+        'temp_unit': temp_unit,
+        'gravity_unit': gravity_unit
+    })[:-1]
+
+    def build(metric_values):
+        metric_params = {
+            brewfather_field: metric_values[metric]
+            for metric, brewfather_field in metric_pairs
+            if metric in metric_values
+        }
+        if not metric_params:
+            return None
+        # swap the metric dict's opening brace for a comma to join the parts
+        return static_prefix + b',' + orjson.dumps(metric_params)[1:]
+
+    return build
+
 
 class PublishingFeature(repeater.RepeaterFeature):
     """
@@ -18,34 +124,8 @@ class PublishingFeature(repeater.RepeaterFeature):
     """
 
     def derive_metric(self, brewfather_field, sensor_config):
-
-        gravity_unit_string = 'specificGravity' if self.gravity_unit == 'G' else 'Plato[degP]'
-
-        temp_metrics = {
-                        'tilt': {
-                            True: f'uncalibratedTemperature[deg{self.temp_unit}]',
-                            False: f'temperature[deg{self.temp_unit}]'
-                         },
-                        'spark': {
-                            False: f'value[deg{self.temp_unit}]'
-                        }
-        }
-
-        metric_matrix = {
-            'temp': temp_metrics,
-            'aux_temp': temp_metrics,
-            'ext_temp': temp_metrics,
-            'gravity': {
-                'tilt': {
-                    True: f'uncalibrated{gravity_unit_string[0].upper()+gravity_unit_string[1:]}',
-                    False: f'{gravity_unit_string}'
-                }
-            }
-        }
-        metric_suffix_str = metric_matrix \
-            .get(brewfather_field, {}) \
-            .get(sensor_config['service_type'], {}) \
-            .get(sensor_config.get('uncalibrated', False), None)
+        metric_suffix_str = _metric_suffixes(self.temp_unit, self.gravity_unit).get(
+            (brewfather_field, sensor_config['service_type'], sensor_config.get('uncalibrated', False)))
 
         return f'{sensor_config["service"]}/{sensor_config["sensor"]}/' \
             + metric_suffix_str if metric_suffix_str else None
@@ -65,11 +145,19 @@ class PublishingFeature(repeater.RepeaterFeature):
         self.name = self.app['config']['name']
         self.interval = max(900.0, self.app['config']['poll_interval'])
 
+        # http.setup() in __main__ created a single long-lived ClientSession
+        # with a shared connection pool; grab the reference once here
+        # instead of looking it up on every tick
+        self.session = http.session(self.app)
+
         config_filename = self.app['config']['metrics_config_file']
         try:
-            # load the config file
-            with open(config_filename) as yamlfile:
-                config_file = safe_load(yamlfile)
+            # load the config file.
+            # file I/O and parsing are blocking, so run them in an executor
+            # rather than stalling the event loop, which matters when the
+            # repeater is restarted while the service is serving requests
+            config_file = await asyncio.get_event_loop().run_in_executor(
+                None, _load_yaml_cached, config_filename)
 
             # extract the global settings
             self.brewfather_url = config_file['settings']['brewfather_url']
@@ -89,82 +177,152 @@ class PublishingFeature(repeater.RepeaterFeature):
                     for brewfather_field, sensor_config in fermenter['sensors'].items()
                 }
 
+            # flatten the mapping once into (metric, brewfather_field) pairs,
+            # so run() can match response metrics with plain dict lookups.
+            # tuples rather than an inverted dict, because two brewfather
+            # fields may share one sensor (e.g. temp and ext_temp)
+            self.metric_pairs = {
+                name: tuple(
+                    (metric, brewfather_field)
+                    for brewfather_field, metric in fields.items()
+                    if metric
+                )
+                for name, fields in self.field_mapping.items()
+            }
+
+            # the metrics endpoint accepts any number of fields,
+            # so all fermenters can share a single request.
+            # The field set is immutable after prepare(),
+            # so the payload can be built once instead of on every tick
+            self.all_fields = {
+                metric
+                for pairs in self.metric_pairs.values()
+                for metric, _ in pairs
+            }
+            self.brewblox_params = {'fields': sorted(self.all_fields)}
+
+            # a fermenter whose sensors all failed to resolve would only
+            # generate empty round-trips; drop it here and warn once
+            # instead of spamming on every tick
+            self.active_fermenters = [
+                name
+                for name, pairs in self.metric_pairs.items()
+                if pairs
+            ]
+            for name in self.metric_pairs.keys() - set(self.active_fermenters):
+                LOGGER.warning('Fermenter "%s" has no valid sensor metrics, and will not be uploaded', name)
+
+            # specialize a payload builder per fermenter,
+            # so run() doesn't re-derive the static parts every tick
+            self.payload_builders = {
+                name: _make_payload_builder(name, self.metric_pairs[name],
+                                            self.temp_unit, self.gravity_unit)
+                for name in self.active_fermenters
+            }
+
         except Exception as e:
             LOGGER.error('Error loading fermenter configuration file: %s', config_filename, exc_info=True)
             raise repeater.RepeaterCancelled from e
 
+    async def _upload_fermenter(self, fermenter_name, metric_values):
+        """Submits a single fermenter's metric values to Brewfather."""
+        # metric keys are only set when a matching response value arrived,
+        # so no None values can end up in the payload
+        brewfather_body = self.payload_builders[fermenter_name](metric_values)
+
+        # a payload without readings would only earn an 'ignored' response;
+        # don't spend the round-trip on it
+        if brewfather_body is None:
+            LOGGER.debug('No metric values returned for fermenter "%s", skipping upload', fermenter_name)
+            return
+
+        LOGGER.debug('Submitted brewfather payload: %s', brewfather_body)
+        try:
+            bf_response = await self.session.post(self.brewfather_url,
+                                                  data=brewfather_body,
+                                                  headers=_JSON_HEADERS)
+
+            # parse the raw bytes ourselves, because brewfather answers
+            # with text/html even when sent an Accept header
+            result = orjson.loads(await bf_response.read())['result']
+            if result == 'success':
+                LOGGER.info('Data submitted successfully')
+            # for some reason, the result is 'OK' now instead of 'ignored' beacause...reasons?
+            elif result == 'OK' or result == 'ignored':
+                LOGGER.warning('Data submission ignored. (Leave at least 900 seconds between logging)')
+            else:
+                LOGGER.warning('%s', await bf_response.text())
+        except ClientResponseError:
+            LOGGER.error('Request to Brewfather API failed', exc_info=True)
+
     async def run(self):
         """
         This function must be implemented by child classes of RepeaterFeature.
         After prepare(), the base class keeps calling run() until the service shuts down.
         """
 
-        # These are available because we called the setup functions in __main__
-        # If you ever get a KeyError when trying to get these, you forgot to call setup()
-        session = http.session(self.app)
-
-        for fermenter_name, fields in self.field_mapping.items():
-            brewblox_params = {
-                'fields': list
-                (
-                    {
-                        metric
-                        for metric in fields.values()
-                        if metric is not None
-                    }
-                )
-            }
-            LOGGER.debug('Submitted brewblox fields: %s', brewblox_params)
-            try:
-                response = await session.post(self.metrics_url, json=brewblox_params)
-                response_values = await response.json()
-                LOGGER.debug('Returned brewblox metrics: %s', response_values)
-                bfdata = {
-                    brewfather_field: response_value['value']
-                    for brewfather_field in ['temp', 'gravity', 'aux_temp', 'ext_temp']
-                    for response_value in response_values
-                    if fields.get(brewfather_field, None) == response_value['metric']
-                }
-
-            except ClientResponseError:
-                LOGGER.error(
-                    'Request to Brewblox API failed',
-                    exc_info=True
-                )
-
-            # add name and temp units
-            bfdata['name'] = fermenter_name
-            bfdata['temp_unit'] = self.temp_unit
-            bfdata['gravity_unit'] = self.gravity_unit
+        loop = asyncio.get_event_loop()
+        tick_start = loop.time()
 
-            # clear out any empty fields. todo: This probably isn't actually necessary
-            brewfather_params = {
-                k: v
-                for k, v in bfdata.items()
-                if v is not None
-            }
+        # one batched request covers every fermenter's metrics.
+        # nothing to fetch means nothing worth uploading either
+        if not self.active_fermenters:
+            await asyncio.sleep(self.interval)
+            return
 
-            LOGGER.debug('Submitted brewfather fields: %s', brewfather_params)
-            try:
-                bf_response = await session.post(self.brewfather_url, json=brewfather_params)
-
-                # have to disable mime-type checking because brewfather uses text/html, even with an Accept header
-                result = (await bf_response.json(content_type=None))['result']
-                if result == 'success':
-                    LOGGER.info('Data submitted successfully')
-                # for some reason, the result is 'OK' now instead of 'ignored' beacause...reasons?
-                elif result == 'OK' or result == 'ignored':
-                    LOGGER.warning('Data submission ignored. (Leave at least 900 seconds between logging)')
-                else:
-                    LOGGER.warning('%s', await bf_response.text())
-            except ClientResponseError:
-                LOGGER.error('Request to Brewfather API failed', exc_info=True)
+        LOGGER.debug('Submitted brewblox fields: %s', self.brewblox_params)
+        metric_values = dict()
+        try:
+            # the context manager releases the response even when the
+            # streaming loop breaks out with the body partially read
+            async with self.session.post(self.metrics_url,
+                                         data=orjson.dumps(self.brewblox_params),
+                                         headers=_JSON_HEADERS) as response:
+                # stream-parse the response instead of materializing the full list,
+                # and stop reading once every requested metric has a value.
+                # the loop runs once per response item, so keep the lookups local
+                all_fields = self.all_fields
+                expected = len(all_fields)
+                async for response_value in ijson.items(response.content, 'item'):
+                    metric = response_value['metric']
+                    if metric in all_fields:
+                        metric_values[metric] = response_value['value']
+                        if len(metric_values) == expected:
+                            break
+            LOGGER.debug('Returned brewblox metrics: %s', metric_values)
+        except ClientResponseError:
+            # without Brewblox data there is nothing to upload;
+            # skip the Brewfather requests entirely until the next tick
+            LOGGER.error(
+                'Request to Brewblox API failed',
+                exc_info=True
+            )
+        else:
+            # fermenters are independent of each other,
+            # so their uploads can be in flight at the same time.
+            # _upload_fermenter handles its own ClientResponseError;
+            # anything else is unexpected and should at least be visible.
+            # (asyncio.TaskGroup would do this for us, but needs Python 3.11)
+            results = await asyncio.gather(
+                *[
+                    self._upload_fermenter(fermenter_name, metric_values)
+                    for fermenter_name in self.active_fermenters
+                ],
+                return_exceptions=True
+            )
+            for fermenter_name, result in zip(self.active_fermenters, results):
+                if isinstance(result, Exception):
+                    LOGGER.error('Upload for fermenter "%s" failed: %s', fermenter_name, result)
 
         """
         To prevent spam, it is strongly recommended to use asyncio.sleep().
         asyncio.sleep() is non-blocking - other services and endpoint handlers will run.
         """
-        await asyncio.sleep(self.interval)
+        # count the interval from the start of the tick, so the effective
+        # period doesn't drift by the per-tick work time.
+        # Brewfather ignores submissions less than 900s apart,
+        # so a drifting cadence eventually costs a data point
+        await asyncio.sleep(max(0.0, self.interval - (loop.time() - tick_start)))
 
 
 def setup(app: web.Application):